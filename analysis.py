@@ -1,12 +1,55 @@
+import argparse
+import fnmatch
+import functools
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import sys
+import time
+import traceback
+import tracemalloc
+import weakref
+
+import numpy as np
 import pandas as pd
-import seaborn as sns
+
+# matplotlib and seaborn are imported where figures are drawn, so computing
+# proportions never loads them.
 
 # Definitions
 """df = pd.read_excel(
     "CCTC Wave 1 Dataset for Public Distribution.xlsx",
     sheet_name=1
 )"""
-df = pd.read_pickle('data/pickled_df')
+data_path = 'data/pickled_df'
+excel_path = 'CCTC Wave 1 Dataset for Public Distribution.xlsx'
+cache_path = 'data/survey.parquet'
+schema_path = 'data/schema.json'
+results_path = 'data/results'
+figure_settings = {'figure.figsize': (24, 16)}
+# Part of every result cache key; bump it whenever the tables an Analysis
+# produces change, so results cached by older code are not served.
+cache_version = 3
+report_spec_path = 'jobs/report.json'
+export_path = 'data/results.arrow'
+
+
+@functools.lru_cache(maxsize=None)
+def load_df(path=data_path):
+    return normalize_df(pd.read_pickle(path))
+
+
+def __getattr__(name):
+    # Keep `analysis.df` and `analysis.report_jobs` working without reading
+    # the dataset or the job spec at import time.
+    if name == 'df':
+        return load_df()
+    if name == 'report_jobs':
+        return load_spec()
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
 
 metadata = {
     'categories': {
@@ -22,92 +65,713 @@ metadata = {
         'region_large': 'REGION4',
         'region_small': 'REGION9',
     },
+    # Survey weight column; None gives unweighted proportions.
+    'weight': None,
 }
 
 
+# Storage
+def normalize_df(df, metadata=metadata, max_ratio=0.5):
+    # Dimension and answer columns hold a handful of distinct strings, so
+    # categoricals store them as small integer codes. Free-text (TEXT)
+    # columns and anything close to unique are left alone.
+    dimensions = set(metadata['categories'].values())
+    columns = {}
+    for column in df.columns:
+        series = df[column]
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            continue
+        if not (pd.api.types.is_object_dtype(series.dtype) or pd.api.types.is_string_dtype(series.dtype)):
+            continue
+        if column in dimensions or (
+                'TEXT' not in column
+                and series.nunique(dropna=True) <= max_ratio * max(len(series), 1)
+        ):
+            columns[column] = series.astype('category')
+    if not columns:
+        return df
+    return df.assign(**columns)
+
+
+def pack_answers(encoded):
+    # Eight respondents per byte along the row axis.
+    return (np.packbits(encoded, axis=0), encoded.shape[0])
+
+
+def unpack_answers(packed):
+    (bits, rows) = packed
+    return np.unpackbits(bits, axis=0, count=rows).astype(bool)
+
+
+def add_columns(df, names, values):
+    # Add (or replace) a (rows x names) block in one concat instead of one
+    # insert per column, which fragments wide frames.
+    block = pd.DataFrame(values, index=df.index, columns=list(names))
+    return pd.concat([df.drop(columns=[name for name in names if name in df.columns]), block], axis=1)
+
+
+# Answer encoding
+def encode_answers(column, answers):
+    # Factorize once, compare each distinct value against the answers, then
+    # broadcast the (values x answers) lookup table back out by code.
+    codes, uniques = pd.factorize(column, use_na_sentinel=False)
+    table = np.array(
+        [[str(value) == answer for answer in answers] for value in uniques],
+        dtype=bool,
+    ).reshape(len(uniques), len(answers))
+    return table[codes]
+
+
+# Instrumentation
+logger = logging.getLogger(__name__)
+
+
+def measure_stage(function, *args, **kwargs):
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.reset_peak()
+    else:
+        tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        result = function(*args, **kwargs)
+    finally:
+        seconds = time.perf_counter() - start
+        (_, peak) = tracemalloc.get_traced_memory()
+        if not tracing:
+            tracemalloc.stop()
+    return result, {'seconds': seconds, 'peak_bytes': peak}
+
+
+def log_stage(analysis, record):
+    # Ready-made instrument callback: Analysis(job, instrument=log_stage).
+    logger.info(
+        '%s: %.4fs, %d rows, %d bytes peak',
+        record['stage'], record['seconds'], record['rows'], record['peak_bytes'],
+    )
+
+
+# Grouped reductions
+def grouped_sums(df, keys, columns, weight=None):
+    # A single grouped sum gives, per group, the weighted yes total of each
+    # answer (columns 0..n-1) plus the weight, squared weight and respondent
+    # totals needed for proportions and effective sample sizes.
+    if weight:
+        weights = df[weight].fillna(0).to_numpy(dtype=float)
+    else:
+        weights = np.ones(df.shape[0])
+    sums = pd.DataFrame(df[columns].to_numpy(dtype=float) * weights[:, None], index=df.index)
+    sums['weight'] = weights
+    sums['weight_sq'] = weights ** 2
+    sums['count'] = 1
+    return sums.groupby(keys, sort=False, observed=True).sum()
+
+
+def combine_sums(sums):
+    # Group totals are additive, so partial sums from chunks (or from newly
+    # appended rows) merge with one more grouped sum. First-seen group order
+    # is kept, matching a single pass over the concatenated rows.
+    sums = [partial for partial in sums if partial is not None]
+    combined = pd.concat(sums)
+    return combined.groupby(level=list(range(combined.index.nlevels)), sort=False, observed=True).sum()
+
+
+def sums_to_proportions(sums, n):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return sums[list(range(n))].to_numpy() / sums['weight'].to_numpy()[:, None]
+
+
+def effective_n(sums):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return sums['weight'].to_numpy() ** 2 / sums['weight_sq'].to_numpy()
+
+
+def bootstrap_proportions(values, weights, codes, n_groups, replicates=1000, seed=0, chunk_size=2 ** 22):
+    # Poisson(1) bootstrap: each replicate reweights every respondent by an
+    # independent Poisson draw, so a (replicates x respondents) weight matrix
+    # times the answer matrix gives all replicate totals at once. Replicates
+    # are drawn in chunks of about chunk_size cells to bound memory.
+    rng = np.random.default_rng(seed)
+    (rows, n_answers) = values.shape
+    estimates = np.full((replicates, n_groups, n_answers), np.nan)
+    members = [np.flatnonzero(codes == group) for group in range(n_groups)]
+    step = max(1, chunk_size // max(rows, 1))
+    for start in range(0, replicates, step):
+        stop = min(start + step, replicates)
+        resample = rng.poisson(1.0, (stop - start, rows)) * weights
+        for (group, rows_in_group) in enumerate(members):
+            group_weights = resample[:, rows_in_group]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                estimates[start:stop, group] = (
+                    group_weights @ values[rows_in_group]
+                ) / group_weights.sum(axis=1)[:, None]
+    return estimates
+
+
+# Aggregation
+aggregation_methods = ['any', 'all', 'count']
+
+
+def aggregate_matrix(df, collections, method='any'):
+    # Compile the aggregation into a (columns x groups) membership matrix;
+    # one product with the (respondents x columns) answer matrix then counts
+    # the yes answers in every group at once.
+    columns = list(dict.fromkeys(column for collection in collections for column in collection))
+    position = {column: i for (i, column) in enumerate(columns)}
+    membership = np.zeros((len(columns), len(collections)), dtype=np.float32)
+    for (group, collection) in enumerate(collections):
+        for column in collection:
+            membership[position[column], group] = 1
+    counts = df[columns].to_numpy(dtype=np.float32) @ membership
+    if method == 'any':
+        return counts > 0
+    elif method == 'all':
+        return counts == membership.sum(axis=0)
+    elif method == 'count':
+        return counts.astype(np.int64)
+    raise ValueError('unknown aggregation method {!r}'.format(method))
+
+
+# Filtering
+def check_job(job, metadata=metadata):
+    # Structural checks that need no data: every name a job refers to must
+    # be defined by the job itself or by metadata.
+    problems = []
+    for key in ['categories', 'filters', 'questions']:
+        if key not in job:
+            problems.append('missing {!r}'.format(key))
+    if problems:
+        return problems
+    for key in job['categories'] + list(job['filters'].keys()):
+        if key not in metadata['categories']:
+            problems.append('unknown category {!r}'.format(key))
+    if not job['questions']:
+        problems.append('no questions')
+    answer_columns = list(job['questions'].keys())
+    if 'split_question' in job.keys():
+        if job['split_question'] not in job['questions']:
+            problems.append('split question {!r} not in questions'.format(job['split_question']))
+        else:
+            answer_columns = job['questions'][job['split_question']]
+    if job.get('sort_unlisted', 'last') not in ['last', 'first', 'drop']:
+        problems.append('unknown sort_unlisted {!r}'.format(job['sort_unlisted']))
+    if job.get('aggregation_method', 'any') not in aggregation_methods:
+        problems.append('unknown aggregation method {!r}'.format(job['aggregation_method']))
+    for (name, collection) in job.get('aggregation', {}).items():
+        for column in collection:
+            if column not in answer_columns:
+                problems.append('aggregation {!r} refers to unknown {!r}'.format(name, column))
+    return problems
+
+
+def job_categories(job, metadata=metadata):
+    return {
+        key: metadata['categories'][key]
+        for key in job['categories'] + list(job['filters'].keys())
+    }
+
+
+def job_columns(job, metadata=metadata):
+    weight = [metadata['weight']] if metadata.get('weight') else []
+    return list(job_categories(job, metadata).values()) + list(job['questions'].keys()) + weight
+
+
+def filter_signature(job, categories=metadata['categories']):
+    return tuple(sorted(
+        (categories[category], tuple(sorted(set(values), key=str)))
+        for (category, values) in job['filters'].items()
+    ))
+
+
+class FilterIndex:
+    # Packed bitmaps, one per (dimension column, value), built the first time
+    # a column is filtered on. A filter is then an OR of its values' bitmaps,
+    # ANDed across columns, and only the final mask is unpacked. The frame is
+    # passed in on each call rather than kept, so the index never keeps its
+    # frame alive. A column's bitmaps are rebuilt once the column has been
+    # reassigned; editing single cells in place is not detected.
+    def __init__(self, df, columns=None):
+        self.rows = df.shape[0]
+        self.columns = set(metadata['categories'].values() if columns is None else columns)
+        self.bitmaps = {}
+        self.arrays = {}
+
+    def column_bitmaps(self, df, column):
+        array = df[column].array
+        if self.arrays.get(column) is not array:
+            (codes, uniques) = pd.factorize(array)
+            self.bitmaps[column] = {
+                value: np.packbits(codes == code) for (code, value) in enumerate(uniques)
+            }
+            self.arrays[column] = array
+        return self.bitmaps[column]
+
+    def packed_mask(self, df, signature):
+        mask = np.packbits(np.ones(self.rows, dtype=bool))
+        for (column, values) in signature:
+            if column in self.columns:
+                bitmaps = self.column_bitmaps(df, column)
+                selected = np.zeros_like(mask)
+                for value in values:
+                    if value in bitmaps:
+                        selected |= bitmaps[value]
+            else:
+                selected = np.packbits(df[column].isin(values).to_numpy())
+            mask &= selected
+        return mask
+
+    def mask(self, df, signature):
+        return np.unpackbits(self.packed_mask(df, signature), count=self.rows).astype(bool)
+
+
+_filter_indexes = {}
+
+
+def filter_index(df):
+    # One FilterIndex per live frame; entries go away with their frame, and
+    # are replaced if rows were added or removed since.
+    key = id(df)
+    entry = _filter_indexes.get(key)
+    if entry is None or entry[0]() is not df:
+        entry = _filter_indexes[key] = (weakref.ref(df), FilterIndex(df))
+        weakref.finalize(df, _filter_indexes.pop, key, None)
+    elif entry[1].rows != df.shape[0]:
+        entry = _filter_indexes[key] = (entry[0], FilterIndex(df))
+    return entry[1]
+
+
+def filter_mask(df, signature):
+    if not signature:
+        return np.ones(df.shape[0], dtype=bool)
+    return filter_index(df).mask(df, signature)
+
+
+# Sorting
+def group_order(groups, sort_order, unlisted='last'):
+    # Groups named in sort_order come in that order; the rest keep their
+    # first-seen order and go 'last', 'first', or are dropped with 'drop'.
+    present = set(groups)
+    listed = [group for group in dict.fromkeys(sort_order) if group in present]
+    listed_set = set(listed)
+    rest = [group for group in groups if group not in listed_set]
+    if unlisted == 'last':
+        return listed + rest
+    elif unlisted == 'first':
+        return rest + listed
+    elif unlisted == 'drop':
+        return listed
+    raise ValueError('unknown placement for unlisted groups {!r}'.format(unlisted))
+
+
+# Plotting
+def barplot(proportions_melted, labels={}, xtick_rotation=None, palette="viridis", **kwargs):
+    import seaborn as sns
+    plot = sns.barplot(
+        data=proportions_melted,
+        hue='variable',
+        palette=palette,
+        x='index',
+        y='value',
+        **kwargs
+    )
+    if 'title' in labels:
+        plot.set_title(labels['title'])
+    if 'xlabel' in labels:
+        plot.set(xlabel=labels['xlabel'])
+    if 'ylabel' in labels:
+        plot.set(ylabel=labels['ylabel'])
+    if 'lower' in proportions_melted.columns:
+        errorbars(plot, proportions_melted, kwargs.get('hue_order'))
+    if xtick_rotation:
+        for item in plot.get_xticklabels():
+            item.set_rotation(xtick_rotation)
+    plot.legend(bbox_to_anchor=(1, 1), loc=2)
+    return plot
+
+
+# Columnar cache
+def build_cache(source=excel_path, path=cache_path, sort_by=('REGION9',), row_group_size=10000):
+    if source.endswith('.xlsx'):
+        _df = pd.read_excel(source, sheet_name=1)
+    else:
+        _df = pd.read_pickle(source)
+    # Answers are matched on str(cell), so every object column is stored as
+    # those strings. Left to Parquet, a column of integer codes with blanks
+    # would come back as floats and '5.0' would never match '5'.
+    for column in _df.columns:
+        if pd.api.types.is_object_dtype(_df[column].dtype):
+            _df[column] = _df[column].map(lambda cell: cell if pd.isna(cell) else str(cell))
+    _df = normalize_df(_df)
+    # Sorting on the usual filter columns keeps each row group's min/max
+    # statistics narrow, so predicate pushdown can skip whole groups.
+    sort_by = [column for column in sort_by if column in _df.columns]
+    if sort_by:
+        _df = _df.sort_values(sort_by, kind='stable')
+    _df.to_parquet(path, index=False, row_group_size=row_group_size)
+    build_schema(_df, schema_file(path), data_fingerprint(path))
+    return path
+
+
+def pushdown_filters(jobs, metadata=metadata):
+    # Disjunctive normal form: a row is read if it passes any job's filters.
+    signatures = {filter_signature(job, metadata['categories']) for job in jobs}
+    if () in signatures:
+        return None
+    return [
+        [(column, 'in', list(values)) for (column, values) in signature]
+        for signature in sorted(signatures)
+    ]
+
+
+def load_columns(columns, filters=None, path=cache_path):
+    return pd.read_parquet(path, columns=list(columns), filters=filters)
+
+
+def resolve_data_path(path=None):
+    if path is None:
+        path = cache_path if os.path.exists(cache_path) else data_path
+    return path
+
+
+def job_projection(jobs, metadata=metadata):
+    jobs = list(jobs)
+    columns = list(dict.fromkeys(column for job in jobs for column in job_columns(job, metadata)))
+    return columns, pushdown_filters(jobs, metadata)
+
+
+def load_projection(columns, filters, metadata=metadata, path=None):
+    path = resolve_data_path(path)
+    if not path.endswith('.parquet'):
+        return load_df(path)
+    return normalize_df(load_columns(columns, filters, path), metadata)
+
+
+def load_jobs_df(jobs, metadata=metadata, path=None):
+    (columns, filters) = job_projection(jobs, metadata)
+    return load_projection(columns, filters, metadata, path)
+
+
+def errorbars(plot, proportions_melted, hue_order=None):
+    # Seaborn draws one bar container per hue level, bars in x order.
+    if hue_order is None:
+        hue_order = list(dict.fromkeys(proportions_melted['variable']))
+    intervals = proportions_melted.set_index(['variable', 'index'])[['value', 'lower', 'upper']]
+    order = list(dict.fromkeys(proportions_melted['index']))
+    for (group, container) in zip(hue_order, plot.containers):
+        for (answer, bar) in zip(order, container):
+            if (group, answer) not in intervals.index:
+                continue
+            (value, lower, upper) = intervals.loc[(group, answer)].to_numpy(dtype=float)
+            plot.errorbar(
+                bar.get_x() + bar.get_width() / 2,
+                value,
+                yerr=[[value - lower], [upper - value]],
+                fmt='none',
+                ecolor='black',
+                capsize=3,
+            )
+
+
 # Analysis object
 class Analysis:
     def __init__(
             self,
             job,
-            df=df,
+            df=None,
             metadata=metadata,
+            shared=None,
+            plot=True,
+            lazy=False,
+            instrument=False,
     ):
-        self.categories = {
-            key: metadata['categories'][key]
-            for key in job['categories'] + list(job['filters'].keys())
-        }
-        self.columns = list(self.categories.values()) + list(job['questions'].keys())
-        self.dataframes = {'df': df[self.columns]}
+        problems = check_job(job, metadata)
+        if problems:
+            raise ValueError('invalid job: {}'.format('; '.join(problems)))
+        self.categories = job_categories(job, metadata)
+        self.columns = job_columns(job, metadata)
         self.job = job
+        self.metadata = metadata
+        self.weight = metadata.get('weight')
         self.plots ={}
-        self.filter_self()
-        self.collect_answers()
-        self.aggregate_answers()
-        self.get_proportions_df()
-        if 'sort_order' in job.keys():
-            self.sort_proportions_melted_df()
-        self.make_seaborn_barplot()
+        self.df_metadata = {}
+        self.instrument = instrument
+        self.stages = []
+        self.computed = False
+        if shared:
+            # Already filtered by AnalysisBatch; encodings are shared too.
+            self.dataframes = {'df': shared['df'][self.columns]}
+            self.encodings = shared['encodings']
+            self.filtered = True
+        else:
+            self.dataframes = {'df': df}
+            self.encodings = {}
+            self.filtered = False
+        if not lazy:
+            self.run(plot=plot)
+
+
+    def run(self, plot=True):
+        self.compute()
+        if plot:
+            self.stage(self.make_seaborn_barplot)
+
+
+    def compute(self):
+        # Memoized: the pipeline runs once, on first use.
+        if not self.computed:
+            self.prepare()
+            self.stage(self.get_proportions_df)
+            self.finish()
+            self.computed = True
+        return self
+
+
+    def render(self, filename=None, **kwargs):
+        self.compute()
+        if 'seaborn_barplot' not in self.plots:
+            self.stage(self.make_seaborn_barplot, **kwargs)
+        plot = self.plots['seaborn_barplot']
+        if filename:
+            plot.get_figure().savefig(filename, bbox_inches='tight')
+        return plot
+
+
+    @property
+    def proportions(self):
+        return self.compute().dataframes['proportions']
+
+
+    @property
+    def proportions_melted(self):
+        return self.compute().dataframes['proportions_melted']
+
+
+    def prepare(self):
+        if self.dataframes['df'] is None:
+            self.dataframes['df'] = load_jobs_df([self.job], self.metadata)
+        if not self.filtered:
+            self.stage(self.filter_self)
+            self.filtered = True
+        self.stage(self.collect_answers)
+        self.stage(self.aggregate_answers)
+
+
+    def finish(self):
+        if 'confidence' in self.job.keys():
+            self.stage(self.get_confidence_intervals, **self.job['confidence'])
+        if self.job.get('crosstab'):
+            self.stage(self.get_crosstab_df)
+        if 'sort_order' in self.job.keys():
+            self.stage(self.sort_proportions_melted_df)
+
+
+    def stage(self, function, *args, **kwargs):
+        # With instrument set, record wall time, peak allocation and the rows
+        # left afterwards; a callable instrument also receives each record.
+        if not self.instrument:
+            return function(*args, **kwargs)
+        (result, record) = measure_stage(function, *args, **kwargs)
+        record.update({'stage': function.__name__, 'rows': self.dataframes['df'].shape[0]})
+        self.stages.append(record)
+        if callable(self.instrument):
+            self.instrument(self, record)
+        return result
+
+
+    @classmethod
+    def restore(cls, result, metadata=metadata):
+        # Rebuild a computed Analysis from a ResultCache entry.
+        self = cls(result['job'], metadata=metadata, lazy=True)
+        self.df_metadata = result['df_metadata']
+        self.dataframes.update(result['dataframes'])
+        self.computed = True
+        return self
 
 
     def filter_self(self):
+        # Mask the source frame first and project afterwards: one copy.
         _df = self.dataframes['df']
-        for (category, values) in self.job['filters'].items():
-            _df = _df[_df[self.categories[category]].isin(values)]
-        self.dataframes['df'] = _df
+        mask = filter_mask(_df, filter_signature(self.job, self.categories))
+        self.dataframes['df'] = _df.loc[mask, self.columns]
 
 
     def collect_answers(self):
         _df = self.dataframes['df']
         if ('split_question' in list(self.job.keys())):
-            for answer in self.job['questions'][self.job['split_question']]:
-                _df[answer] = _df[self.job['split_question']].apply(lambda cell: True if str(cell) in answer else False)
+            answers = self.job['questions'][self.job['split_question']]
+            self.dataframes['df'] = add_columns(_df, answers, self.encode(self.job['split_question'], answers))
         else:
-            for (question, answers) in self.job['questions'].items():
-                _df[question] = _df[question].apply(lambda cell: True if str(cell) in answers else False)
-        self.dataframes['df'] = _df
+            questions = list(self.job['questions'].keys())
+            encoded = np.column_stack([
+                self.encode(question, self.job['questions'][question]).any(axis=1)
+                for question in questions
+            ])
+            self.dataframes['df'] = add_columns(_df, questions, encoded)
+
+
+    def encode(self, question, answers):
+        key = (question, tuple(answers))
+        if key not in self.encodings:
+            self.encodings[key] = pack_answers(encode_answers(self.dataframes['df'][question], answers))
+        return unpack_answers(self.encodings[key])
 
 
     def aggregate_answers(self):
         _df = self.dataframes['df']
         if 'aggregation' in list(self.job.keys()):
-            for (name, collection) in self.job['aggregation'].items():
-                aggregate_df = pd.DataFrame(_df[collection])
-                _df[name] = aggregate_df.any(axis=1)
+            names = list(self.job['aggregation'].keys())
+            _df = add_columns(_df, names, aggregate_matrix(
+                _df,
+                [self.job['aggregation'][name] for name in names],
+                self.job.get('aggregation_method', 'any'),
+            ))
         else:
             pass
         self.dataframes['df'] = _df
 
 
+    def answer_columns(self):
+        if 'aggregation' in list(self.job.keys()):
+            return list(self.job['aggregation'].keys())
+        elif 'split_question' in list(self.job.keys()):
+            return list(self.job['questions'][self.job['split_question']])
+        else:
+            return list(self.job['questions'].keys())
+
+
+    def get_group_sums(self, group_by=None):
+        _df = self.dataframes['df']
+        if not group_by:
+            group_by = self.job['categories'][0]
+        # One grouped reduction over the boolean answer matrix: rows are
+        # groups, columns are answers.
+        return grouped_sums(_df, _df[self.categories[group_by]], self.answer_columns(), self.weight)
+
+
     def get_proportions_df(self, groups=None, group_by=None):
+        self.set_proportions(self.get_group_sums(group_by), groups)
+
+
+    def set_proportions(self, sums, groups=None):
+        columns = self.answer_columns()
+        if groups:
+            sums = sums.reindex(list(groups))
+        groups = list(sums.index)
+        proportions = sums_to_proportions(sums, len(columns))
+        self.df_metadata.update({
+            'categories': columns,
+            'groups': groups,
+            'weight': self.weight,
+        })
+        self.dataframes.update({
+            'proportions': pd.DataFrame(
+                proportions.T,
+                columns=groups,
+            ).assign(index=columns)[['index'] + groups],
+            'proportions_melted': pd.DataFrame({
+                # Object arrays keep group values as they are; NumPy would turn
+                # mixed values such as [1, 'a'] into strings.
+                'index': np.tile(pd.Index(columns, dtype=object), len(groups)),
+                'variable': pd.Index(groups, dtype=object).repeat(len(columns)),
+                'value': proportions.ravel(),
+            }),
+            'sums': sums,
+            'sample_sizes': pd.DataFrame({
+                'variable': groups,
+                'count': sums['count'].to_numpy(),
+                'weight': sums['weight'].to_numpy(),
+                'effective_n': effective_n(sums),
+            }),
+        })
+
+
+    def get_confidence_intervals(self, replicates=1000, level=0.95, seed=0, group_by=None):
         _df = self.dataframes['df']
-        aggregate = True if 'aggregation' in list(self.job.keys()) else False
-        split = True if 'split_question' in list(self.job.keys()) else False
         if not group_by:
             group_by = self.job['categories'][0]
-        if not groups:
-            groups = set(_df[self.categories[group_by]])
-        if aggregate:
-            columns = self.job['aggregation'].keys()
-        elif split:
-            columns = self.job['questions'][self.job['split_question']]
+        columns = self.answer_columns()
+        groups = self.df_metadata['groups']
+        if self.weight:
+            weights = _df[self.weight].fillna(0).to_numpy(dtype=float)
         else:
-            columns = self.job['questions'].keys()
-        results = {'index': list(columns)}
-        for group in groups:
-            group_df = _df[_df[self.categories[group_by]] == group]
-            proportions = []
-            for column in columns:
-                proportions.append(group_df[column].values.sum() / group_df.shape[0])
-            results.update({group: proportions})
-        self.df_metadata = {
-            'categories': list(columns),
-            'groups': list(groups),
-        }
-        self.dataframes.update({
-            'proportions': pd.DataFrame(results),
-            'proportions_melted': pd.melt(pd.DataFrame(results), id_vars=['index'])
+            weights = np.ones(_df.shape[0])
+        codes = pd.Categorical(_df[self.categories[group_by]], categories=groups).codes
+        estimates = bootstrap_proportions(
+            _df[columns].to_numpy(dtype=float),
+            weights,
+            codes,
+            len(groups),
+            replicates=replicates,
+            seed=seed,
+        )
+        alpha = (1 - level) / 2
+        (lower, upper) = np.nanquantile(estimates, [alpha, 1 - alpha], axis=0)
+        # proportions_melted is still in (group, answer) order here.
+        self.df_metadata.update({
+            'confidence': {'replicates': replicates, 'level': level, 'seed': seed},
         })
+        self.dataframes['proportions_melted'] = self.dataframes['proportions_melted'].assign(
+            lower=lower.ravel(),
+            upper=upper.ravel(),
+        )
+
+
+    def get_crosstab_sums(self, group_by=None):
+        _df = self.dataframes['df']
+        if not group_by:
+            group_by = self.job['categories']
+        # Group on every category at once. Only observed combinations come
+        # back, so empty cells of the cartesian product are never stored.
+        return grouped_sums(
+            _df,
+            [_df[self.categories[category]].rename(category) for category in group_by],
+            self.answer_columns(),
+            self.weight,
+        )
+
+
+    def get_crosstab_df(self, group_by=None):
+        if not group_by:
+            group_by = self.job['categories']
+        self.set_crosstab(self.get_crosstab_sums(group_by), group_by)
+
+
+    def set_crosstab(self, sums, group_by):
+        columns = self.answer_columns()
+        cells = sums.index.to_frame(index=False)
+        self.df_metadata.update({'crosstab': list(group_by)})
+        self.dataframes['crosstab_sums'] = sums
+        self.dataframes['crosstab'] = cells.loc[
+            cells.index.repeat(len(columns))
+        ].reset_index(drop=True).assign(
+            index=np.tile(columns, len(cells)),
+            value=sums_to_proportions(sums, len(columns)).ravel(),
+            count=np.repeat(sums['count'].to_numpy(), len(columns)),
+            effective_n=np.repeat(effective_n(sums), len(columns)),
+        )
+
+
+    def update(self, rows):
+        # Fold newly appended respondents into the stored group sums. Only
+        # the new rows are filtered, encoded and reduced, and the tables come
+        # out as a full recompute over old and new rows would. The
+        # respondent frame itself is not extended.
+        if 'confidence' in self.job.keys():
+            raise ValueError('bootstrap confidence intervals cannot be updated incrementally')
+        self.compute()
+        delta = Analysis(self.job, df=rows, metadata=self.metadata, lazy=True)
+        delta.prepare()
+        self.set_proportions(combine_sums([self.dataframes['sums'], delta.get_group_sums()]))
+        if 'crosstab_sums' in self.dataframes:
+            group_by = self.df_metadata['crosstab']
+            self.set_crosstab(
+                combine_sums([self.dataframes['crosstab_sums'], delta.get_crosstab_sums(group_by)]),
+                group_by,
+            )
+        if 'sort_order' in self.job.keys():
+            self.sort_proportions_melted_df()
+        self.plots = {}
+        return self
 
 
     def make_seaborn_barplot(self, palette="viridis", **kwargs):
@@ -121,45 +785,507 @@ class Analysis:
         #         **kwargs
         #     )
         # else:
-        plot = sns.barplot(
-            data=self.dataframes['proportions_melted'],
-            hue='variable',
+        # The figure stays open for the caller to show or save; close it
+        # with plt.close(analysis.plots['seaborn_barplot'].figure).
+        if 'ax' not in kwargs:
+            import matplotlib.pyplot as plt
+            (figure, kwargs['ax']) = plt.subplots(figsize=figure_settings['figure.figsize'])
+        kwargs.setdefault('hue_order', self.df_metadata['groups'])
+        plot = barplot(
+            self.dataframes['proportions_melted'],
+            labels=self.job.get('labels', {}),
+            xtick_rotation=self.job.get('xtick_rotation'),
             palette=palette,
-            x='index',
-            y='value',
             **kwargs
         )
-        if 'labels' in self.job:
-            labels = self.job['labels']
-            if 'title' in labels:
-                plot.set_title(labels['title'])
-            if 'xlabel' in labels:
-                plot.set(xlabel=labels['xlabel'])
-            if 'ylabel' in labels:
-                plot.set(ylabel=labels['ylabel'])
-        plot.legend(bbox_to_anchor=(1, 1), loc=2)
         self.plots.update({'seaborn_barplot': plot})
 
-    def sort_proportions_melted_df(self, sort_order=[]):
+    def sort_proportions_melted_df(self, sort_order=[], unlisted=None):
         if 'sort_order' in self.job.keys():
             sort_order = self.job['sort_order']
+        if unlisted is None:
+            unlisted = self.job.get('sort_unlisted', 'last')
+        order = group_order(self.df_metadata['groups'], sort_order, unlisted)
+        # Rank every row by its group's position in one pass; a stable sort
+        # keeps answers in their original order within each group.
         _df = self.dataframes['proportions_melted']
-        df_list = []
-        for item in sort_order:
-            df_list.append(_df[_df['variable'] == item])
-        self.dataframes['proportions_melted'] = pd.concat(df_list)
+        codes = pd.Categorical(_df['variable'], categories=order, ordered=True).codes
+        keep = np.flatnonzero(codes >= 0)
+        self.dataframes['proportions_melted'] = _df.iloc[keep[np.argsort(codes[keep], kind='stable')]]
+        self.dataframes['proportions'] = self.dataframes['proportions'][['index'] + order]
+        self.df_metadata['groups'] = order
 
     def convert_qs_to_questions(self):
         self.dataframes['proportions_melted']['index'] = [self.job['questions'][q][0] for q in list(self.dataframes['proportions_melted']['index'])]
 
 
-def column_values(question):
-    columns = list(df.columns)
-    values = [set(df[column]) for column in list(df.columns)]
-    column_list = [match for match in columns if question in match and 'TEXT' not in match]
-    for column in column_list:
-        index = columns.index(column)
-        print("{}: {}".format(columns[index], values[index]))
+# Streaming
+def read_chunks(path, columns, filters=None, chunk_size=100000, numeric=()):
+    if path.endswith('.parquet'):
+        import pyarrow.dataset
+        import pyarrow.parquet
+        dataset = pyarrow.dataset.dataset(path, format='parquet')
+        expression = pyarrow.parquet.filters_to_expression(filters) if filters else None
+        for batch in dataset.to_batches(columns=list(columns), filter=expression, batch_size=chunk_size):
+            yield batch.to_pandas()
+    elif path.endswith('.csv'):
+        # Read as text, like the Parquet cache stores answers, so integer
+        # codes with blanks are not turned into floats.
+        dtype = {column: str for column in columns if column not in numeric}
+        for chunk in pd.read_csv(path, usecols=list(columns), dtype=dtype, chunksize=chunk_size):
+            yield chunk
+    else:
+        raise ValueError('streaming needs a Parquet or CSV source, not {!r}'.format(path))
+
+
+def stream_analyses(jobs, path=None, metadata=metadata, chunk_size=100000, plot=False):
+    # Each chunk is filtered and encoded per job, reduced to group sums and
+    # folded into a running total, so peak memory is one chunk plus the
+    # per-group totals. Bootstrap intervals need every row and are not
+    # available here.
+    if any('confidence' in job.keys() for job in jobs):
+        raise ValueError('bootstrap confidence intervals are not supported when streaming')
+    path = resolve_data_path(path)
+    (columns, filters) = job_projection(jobs, metadata)
+    sums = [None] * len(jobs)
+    numeric = [metadata['weight']] if metadata.get('weight') else []
+    empty = None
+    for chunk in read_chunks(path, columns, filters, chunk_size, numeric):
+        # Only the sums outlive a chunk; each job's filtered copy is dropped
+        # before the next job is prepared.
+        for (i, job) in enumerate(jobs):
+            analysis = Analysis(job, df=chunk, metadata=metadata, lazy=True)
+            analysis.prepare()
+            sums[i] = combine_sums([sums[i], analysis.get_group_sums()])
+            del analysis
+        empty = chunk.iloc[:0]
+    if empty is None:
+        raise ValueError('no rows read from {!r}'.format(path))
+    analyses = []
+    for (i, job) in enumerate(jobs):
+        analysis = Analysis(job, df=empty, metadata=metadata, lazy=True)
+        analysis.prepare()
+        analysis.set_proportions(sums[i])
+        analysis.finish()
+        analysis.computed = True
+        if plot:
+            analysis.render()
+        analyses.append(analysis)
+    return analyses
+
+
+def stream_analysis(job, path=None, metadata=metadata, chunk_size=100000, plot=False):
+    return stream_analyses([job], path, metadata, chunk_size, plot)[0]
+
+
+# Batch of Analysis jobs
+class AnalysisBatch:
+    def __init__(
+            self,
+            jobs,
+            df=None,
+            metadata=metadata,
+            plot=False,
+            instrument=False,
+    ):
+        # Figures are off by default: a batch can hold hundreds of jobs and
+        # each plot keeps an open figure. render_all draws them separately.
+        if df is None:
+            df = load_jobs_df(jobs, metadata)
+        self.jobs = jobs
+        self.stages = []
+        self.plan = {}
+        for (i, job) in enumerate(jobs):
+            self.plan.setdefault(filter_signature(job, metadata['categories']), []).append(i)
+        self.analyses = [None] * len(jobs)
+        for (signature, indices) in self.plan.items():
+            columns = list(dict.fromkeys(
+                column for i in indices for column in job_columns(jobs[i], metadata)
+            ))
+            if instrument:
+                (mask, record) = measure_stage(filter_mask, df, signature)
+                self.stages.append(dict(record, job=None, stage='filter_mask', rows=int(mask.sum())))
+            else:
+                mask = filter_mask(df, signature)
+            shared = {
+                'df': df.loc[mask, columns],
+                'encodings': {},
+            }
+            for i in indices:
+                self.analyses[i] = Analysis(
+                    jobs[i],
+                    metadata=metadata,
+                    shared=shared,
+                    plot=plot,
+                    instrument=instrument,
+                )
+                self.stages.extend(dict(record, job=i) for record in self.analyses[i].stages)
+
+    def summary(self, top=10):
+        # The slowest jobs by total time, and time spent per stage overall.
+        records = pd.DataFrame(self.stages, columns=['job', 'stage', 'seconds', 'rows', 'peak_bytes'])
+        jobs = records.dropna(subset=['job']).astype({'job': int}).groupby('job').agg(
+            seconds=('seconds', 'sum'),
+            peak_bytes=('peak_bytes', 'max'),
+            slowest_stage=('seconds', lambda seconds: records.loc[seconds.idxmax(), 'stage']),
+        ).sort_values('seconds', ascending=False).head(top)
+        stages = records.groupby('stage').agg(
+            seconds=('seconds', 'sum'),
+            calls=('seconds', 'size'),
+            peak_bytes=('peak_bytes', 'max'),
+        ).sort_values('seconds', ascending=False)
+        return {'jobs': jobs, 'stages': stages}
+
+    def __iter__(self):
+        return iter(self.analyses)
+
+    def __getitem__(self, i):
+        return self.analyses[i]
+
+    def __len__(self):
+        return len(self.analyses)
+
+
+# Parallel execution
+_worker_state = {}
+
+
+def init_worker(df, metadata):
+    # Under fork the frame is inherited copy-on-write and never pickled;
+    # under spawn it is pickled once per worker, not once per job.
+    _worker_state.update({'df': df, 'metadata': metadata})
+
+
+def run_worker(task):
+    (i, job) = task
+    try:
+        analysis = Analysis(job, df=_worker_state['df'], metadata=_worker_state['metadata'], lazy=True)
+        return (i, analysis_result(analysis.compute()), None)
+    except Exception:
+        return (i, None, traceback.format_exc())
+
+
+class JobError(Exception):
+    def __init__(self, index, trace):
+        super().__init__('job {} failed:\n{}'.format(index, trace))
+        self.index = index
+        self.trace = trace
+
+
+def run_parallel(jobs, df=None, metadata=metadata, processes=None, chunksize=1):
+    # Results come back in job order. A job that raises yields a
+    # JobError in its slot instead of taking down the whole run.
+    if df is None:
+        df = load_jobs_df(jobs, metadata)
+    # Build the filter bitmaps before forking so workers share them.
+    for signature in {filter_signature(job, metadata['categories']) for job in jobs}:
+        filter_mask(df, signature)
+    if 'fork' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('fork')
+    else:
+        context = multiprocessing.get_context()
+    results = [None] * len(jobs)
+    with context.Pool(processes, initializer=init_worker, initargs=(df, metadata)) as pool:
+        for (i, result, error) in pool.imap_unordered(run_worker, enumerate(jobs), chunksize):
+            if error:
+                results[i] = JobError(i, error)
+            else:
+                results[i] = Analysis.restore(result, metadata)
+    return results
+
+
+# Result cache
+def analysis_result(analysis):
+    return {
+        'job': analysis.job,
+        'df_metadata': analysis.df_metadata,
+        'dataframes': {
+            name: frame for (name, frame) in analysis.dataframes.items() if name != 'df'
+        },
+    }
+
+
+def data_fingerprint(path):
+    stat = os.stat(path)
+    return '{}:{}:{}'.format(os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+
+def job_key(job, fingerprint, metadata=metadata):
+    canonical = json.dumps(
+        {'job': job, 'metadata': metadata, 'data': fingerprint, 'version': cache_version},
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+class ResultCache:
+    # One pickle (and optionally one PNG) per job key. Hits refresh the
+    # file's mtime, and the oldest entries are evicted once the directory
+    # grows past max_bytes.
+    def __init__(self, path=results_path, max_bytes=512 * 2 ** 20):
+        self.path = path
+        self.max_bytes = max_bytes
+        os.makedirs(path, exist_ok=True)
+
+    def file(self, key, suffix='.pkl'):
+        return os.path.join(self.path, key + suffix)
+
+    def get(self, key):
+        filename = self.file(key)
+        if not os.path.exists(filename):
+            return None
+        os.utime(filename)
+        return pd.read_pickle(filename)
+
+    def put(self, key, analysis):
+        pd.to_pickle(analysis_result(analysis), self.file(key))
+        self.evict()
+
+    def get_png(self, key, filename):
+        cached = self.file(key, '.png')
+        if not os.path.exists(cached):
+            return False
+        os.utime(cached)
+        shutil.copyfile(cached, filename)
+        return True
+
+    def put_png(self, key, filename):
+        shutil.copyfile(filename, self.file(key, '.png'))
+        self.evict()
+
+    def evict(self):
+        entries = sorted(os.scandir(self.path), key=lambda entry: entry.stat().st_mtime_ns)
+        total = sum(entry.stat().st_size for entry in entries)
+        for entry in entries:
+            if total <= self.max_bytes:
+                break
+            total -= entry.stat().st_size
+            os.remove(entry.path)
+
+
+# Result export
+def export_table(names, analyses, keys=None):
+    # One row per (job, answer, group) in plotting order. Job-level details
+    # (the job itself, df_metadata, cache key) go in the schema metadata as
+    # JSON under b'jobs'.
+    import pyarrow
+    if keys is None:
+        keys = [None] * len(names)
+    frames = []
+    jobs = {}
+    for (name, analysis, key) in zip(names, analyses, keys):
+        melted = analysis.dataframes['proportions_melted']
+        sums = analysis.dataframes['sums']
+        sizes = analysis.dataframes['sample_sizes'].set_index('variable')
+        answers = pd.Index(analysis.df_metadata['categories']).get_indexer(melted['index'])
+        groups = sums.index.get_indexer(melted['variable'])
+        yes = sums[list(range(len(analysis.df_metadata['categories'])))].to_numpy()[groups, answers]
+        frames.append(pd.DataFrame({
+            'job': name,
+            'answer': melted['index'].to_numpy(dtype=object),
+            'group': melted['variable'].astype(str).to_numpy(dtype=object),
+            'proportion': melted['value'].to_numpy(dtype=float),
+            'yes': yes.astype(float),
+            'count': sizes['count'].reindex(melted['variable']).to_numpy(dtype='int64'),
+            'weight': sizes['weight'].reindex(melted['variable']).to_numpy(dtype=float),
+            'effective_n': sizes['effective_n'].reindex(melted['variable']).to_numpy(dtype=float),
+            'lower': melted['lower'].to_numpy(dtype=float) if 'lower' in melted else np.nan,
+            'upper': melted['upper'].to_numpy(dtype=float) if 'upper' in melted else np.nan,
+        }))
+        jobs[name] = {'job': analysis.job, 'df_metadata': analysis.df_metadata, 'key': key}
+    table = pyarrow.Table.from_pandas(pd.concat(frames, ignore_index=True), preserve_index=False)
+    for column in ['job', 'answer', 'group']:
+        index = table.schema.get_field_index(column)
+        table = table.set_column(index, column, table[column].cast(pyarrow.string()).dictionary_encode())
+    return table.replace_schema_metadata({'jobs': json.dumps(jobs, default=str)})
+
+
+def read_results(path=export_path):
+    # Zero-copy: the columns point straight into the memory-mapped file.
+    import pyarrow
+    import pyarrow.ipc
+    return pyarrow.ipc.open_file(pyarrow.memory_map(path)).read_all()
+
+
+def results_jobs(table):
+    return json.loads(table.schema.metadata[b'jobs'])
+
+
+def export_results(names, analyses, path=export_path, keys=None):
+    # Appends to an uncompressed Arrow IPC file so readers can memory-map
+    # it. Rows of a job already in the file are replaced. The merged table
+    # is written beside the old file and swapped in, so readers never see a
+    # partial file.
+    import pyarrow
+    import pyarrow.compute
+    import pyarrow.ipc
+    table = export_table(names, analyses, keys)
+    jobs = results_jobs(table)
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    if os.path.exists(path):
+        existing = read_results(path)
+        jobs = dict(results_jobs(existing), **jobs)
+        kept = existing.filter(pyarrow.compute.invert(pyarrow.compute.is_in(
+            existing['job'].cast(pyarrow.string()),
+            value_set=pyarrow.array(list(names), pyarrow.string()),
+        )))
+        table = pyarrow.concat_tables([kept.replace_schema_metadata(None), table.replace_schema_metadata(None)])
+        table = table.unify_dictionaries()
+    table = table.replace_schema_metadata({'jobs': json.dumps(jobs, default=str)})
+    temporary = path + '.tmp'
+    with pyarrow.OSFile(temporary, 'wb') as sink:
+        with pyarrow.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(temporary, path)
+    return table
+
+
+# Rendering
+def render_task(analysis, filename, palette="viridis"):
+    if not os.path.splitext(filename)[1]:
+        filename += '.png'
+    proportions_melted = analysis.dataframes['proportions_melted']
+    return {
+        'filename': filename,
+        'proportions_melted': proportions_melted[
+            [column for column in ['index', 'variable', 'value', 'lower', 'upper'] if column in proportions_melted.columns]
+        ],
+        'labels': analysis.job.get('labels', {}),
+        'hue_order': analysis.df_metadata['groups'],
+        'xtick_rotation': analysis.job.get('xtick_rotation'),
+        'palette': palette,
+    }
+
+
+def render_barplot(task):
+    import matplotlib.pyplot as plt
+    (figure, ax) = plt.subplots()
+    barplot(
+        task['proportions_melted'],
+        labels=task['labels'],
+        xtick_rotation=task['xtick_rotation'],
+        palette=task['palette'],
+        hue_order=task['hue_order'],
+        ax=ax,
+    )
+    figure.savefig(task['filename'], bbox_inches='tight')
+    plt.close(figure)
+    return task['filename']
+
+
+def init_renderer(rc=figure_settings):
+    import matplotlib
+    matplotlib.use('Agg')
+    import seaborn as sns
+    sns.set(rc=rc)
+
+
+def render_all(tasks, processes=None, rc=figure_settings):
+    # One figure per task on a non-interactive backend; only the small
+    # melted frames cross the process boundary.
+    with multiprocessing.Pool(processes, initializer=init_renderer, initargs=(rc,)) as pool:
+        return pool.map(render_barplot, tasks)
+
+
+# Schema index
+def column_counts(column, series):
+    # {str(value): count}. Answers are matched on str(cell), so the index is
+    # keyed the same way. Free-text columns keep only their name.
+    if 'TEXT' in column:
+        return {}
+    counts = series.value_counts(dropna=True, sort=False)
+    return {str(value): int(count) for (value, count) in counts.items() if count}
+
+
+def build_schema(df, path=None, fingerprint=None):
+    schema = {column: column_counts(column, df[column]) for column in df.columns}
+    if path:
+        write_schema(schema, path, fingerprint)
+    return schema
+
+
+def write_schema(schema, path, fingerprint=None):
+    # The data fingerprint is stored alongside, so a schema built from an
+    # older data file is rebuilt rather than trusted.
+    with open(path, 'w') as f:
+        json.dump({'data': fingerprint, 'columns': schema}, f)
+
+
+def build_data_schema(data, path=None):
+    # From the Parquet cache one column is read at a time; a pickle has to
+    # be loaded whole.
+    fingerprint = data_fingerprint(data)
+    if not data.endswith('.parquet'):
+        return build_schema(load_df(data), path, fingerprint)
+    import pyarrow.parquet
+    schema = {
+        column: column_counts(column, load_columns([column], path=data)[column])
+        for column in pyarrow.parquet.read_schema(data).names
+    }
+    if path:
+        write_schema(schema, path, fingerprint)
+    return schema
+
+
+def schema_file(data):
+    # The schema lives next to the data it describes.
+    return os.path.join(os.path.dirname(data), os.path.basename(schema_path))
+
+
+def load_schema(path=None, data=None):
+    data = resolve_data_path(data)
+    return cached_schema(path or schema_file(data), data, data_fingerprint(data))
+
+
+@functools.lru_cache(maxsize=None)
+def cached_schema(path, data, fingerprint):
+    if os.path.exists(path):
+        with open(path) as f:
+            stored = json.load(f)
+        if stored.get('data') == fingerprint and 'columns' in stored:
+            return stored['columns']
+    return build_data_schema(data, path)
+
+
+def schema_columns(question, schema):
+    if any(character in question for character in '*?['):
+        return [column for column in schema if fnmatch.fnmatchcase(column, question) and 'TEXT' not in column]
+    if question in schema:
+        return [question]
+    return [column for column in schema if question in column and 'TEXT' not in column]
+
+
+def validate_job(job, schema=None, metadata=metadata):
+    if schema is None:
+        schema = load_schema()
+    problems = check_job(job, metadata)
+    if problems:
+        return problems
+    for key in job['categories'] + list(job['filters'].keys()):
+        if metadata['categories'][key] not in schema:
+            problems.append('category column {!r} not in data'.format(metadata['categories'][key]))
+    for (key, values) in job['filters'].items():
+        column = metadata['categories'].get(key)
+        for value in values:
+            if column in schema and str(value) not in schema[column]:
+                problems.append('filter value {!r} not found in {}'.format(value, column))
+    for (question, answers) in job['questions'].items():
+        if question not in schema:
+            problems.append('question column {!r} not in data'.format(question))
+            continue
+        for answer in answers:
+            if answer not in schema[question]:
+                problems.append('answer {!r} not found in {}'.format(answer, question))
+    return problems
+
+
+def column_values(question, schema=None):
+    if schema is None:
+        schema = load_schema()
+    for column in schema_columns(question, schema):
+        print("{}: {}".format(column, set(schema[column])))
 
 
 # Example job for testing
@@ -182,416 +1308,133 @@ example_job = {
     },
 }
 
-# Figure Settings
-sns.set(rc={'figure.figsize':(24,16)})
-
-# Analysis Plans
-categories = [
-    'generation',
-    'income_bracket',
-]
-
-filters = {
-    'region_small': ['East North Central'],
-    'generation': [
-        'Silent (1928-45)',
-        'Gen Z (1997-2012)',
-        'Boomers (1946-64)',
-        'Gen X (1965-80)',
-        'Millennials (1981-96)'
-    ],
-}
+# Job specs
+def load_spec(path=report_spec_path):
+    # A spec file holds `jobs` (name -> job) and optional `defaults` that
+    # every job starts from, e.g. the shared categories, filters and
+    # sort_order. JSON always works; YAML needs PyYAML.
+    with open(path) as f:
+        if path.endswith(('.yaml', '.yml')):
+            import yaml
+            spec = yaml.safe_load(f)
+        else:
+            spec = json.load(f)
+    if not isinstance(spec, dict) or not isinstance(spec.get('jobs'), dict):
+        raise ValueError('{}: spec needs a "jobs" mapping'.format(path))
+    defaults = spec.get('defaults') or {}
+    return {name: dict(defaults, **job) for (name, job) in spec['jobs'].items()}
 
-sort_order = ['Silent (1928-45)', 'Boomers (1946-64)', 'Gen X (1965-80)', 'Millennials (1981-96)', 'Gen Z (1997-2012)']
 
-analysis_1 = Analysis({
-    'aggregation': {
-        'ArtMuseum': ['q7_1'],
-        'FoodAndDrink': ['q7_17'],
-        'Theater': ['q7_18', 'q7_19'],
-        'Music': ['q7_21', 'q7_22', 'q7_23', 'q7_24', 'q7_25'],
-        'Dance': ['q7_26', 'q7_27', 'q7_28'],
-    },
-    'categories': categories,
-    'filters': filters,
-    'labels': {
-        'title': 'Did you do any of the following activities last year (2019)?',
-        'xlabel': 'Activity',
-        'ylabel': 'Proportion Responding Yes',
-    },
-    'questions': {
-        'q7_1': ['Art museum'],
-        'q7_17': ['Food and drink experience'],
-        'q7_18': ['Play (non-musical)'],
-        'q7_19': ['Musical'],
-        'q7_21': ['Popular music'],
-        'q7_22': ['Classical music'],
-        'q7_23': ['Jazz music'],
-        'q7_24': ['Opera'],
-        'q7_25': ['World music'],
-        'q7_26': ['Contemporary dance'],
-        'q7_27': ['Ballet'],
-        'q7_28': ['Regional dance'],
-    },
-    'sort_order': sort_order,
-})
-analysis_1.plots['seaborn_barplot'].get_figure().savefig('analysis_1', bbox_inches='tight')
-
-analysis_2 = Analysis({
-    'categories': categories,
-    'filters': filters,
-    'labels': {
-        'title': 'Still thinking back to 2019, about how often did you participate in those kinds of activities — the kind you think of as cultural?',
-        'xlabel': 'Frequency',
-        'ylabel': 'Proportion Responding Yes',
-    },
-    'questions': {
-        'q9': ['A few times a week', 'A few times a month', 'About once a month', 'A few times over the year'],
-    },
-    'sort_order': sort_order,
-    'split_question': 'q9',
-})
-analysis_2.plots['seaborn_barplot'].get_figure().savefig('analysis_2', bbox_inches='tight')
-
-analysis_3 = Analysis({
-    'aggregation':{
-        'Arts Org. Member': ['q34_1'],
-        'Arts Org. Subscriber/Ticket-Holder': ['q34_2'],
-        'Arts Org. Volunteer': ['q34_3'],
-        'Arts Org. Employee': ['q34_4'],
-        'Artist or Arts Educator': ['q34_5'],
-        'None of These': ['q34_99'],
-    },
-    'categories': categories,
-    'filters': filters,
-    'labels': {
-        'title': 'During 2019 (before Covid-19), did any of these apply to you?',
-        'xlabel': 'Question',
-        'ylabel': 'Proportion Responding Yes',
-    },
-    'questions': {
-        'q34_1': ['I was a member of an arts or culture organization'],
-        'q34_2': ['I was a subscriber or season-ticket holder to an arts and culture organization'],
-        'q34_3': ['I volunteered at an arts or culture organization'],
-        'q34_4': ['I was employed by an arts or culture organization'],
-        'q34_5': ['I earned money as an artist or arts educator/ teaching artist'],
-        'q34_99': ['None of these'],
-    },
-    'sort_order': sort_order,
-})
-analysis_3.plots['seaborn_barplot'].get_figure().savefig('analysis_3', bbox_inches='tight')
-
-
-analysis_4 = Analysis({
-    'categories': categories,
-    'filters': filters,
-    'labels': {
-        'title': 'During a crisis like Covid-19, how important or unimportant are arts & culture organizations to you?',
-        'xlabel': '"Not Important at All" to "Extremely Important"',
-        'ylabel': 'Proportion Responding Yes',
-    },
-    'questions': {'q17': ['1', '2', '3', '4', '5']},
-    'sort_order': sort_order,
-    'split_question': 'q17',
-})
-analysis_4.plots['seaborn_barplot'].get_figure().savefig('analysis_4', bbox_inches='tight')
-
-
-analysis_5 = Analysis({
-    'categories': categories,
-    'filters': filters,
-    'labels': {
-        'title': 'Has your income changed because of Covid-19?',
-        'xlabel': 'Income Impact',
-        'ylabel': 'Proportion Responding Yes',
-    },
-    'questions': {
-        'q32': ['No, there has been no change to my income',
-                'Yes, I have no income now',
-                'Prefer not to answer',
-                'Yes, I still have some income but less than before']
-    },
-    'sort_order': sort_order,
-    'split_question': 'q32',
-})
-analysis_5.plots['seaborn_barplot'].get_figure().savefig('analysis_5', bbox_inches='tight')
+def compile_plan(jobs, schema=None, metadata=metadata):
+    # Check every job against metadata and the schema before any data is
+    # read, then collect the one projection (columns and row filters) that
+    # serves them all.
+    if schema is None:
+        schema = load_schema()
+    problems = [
+        '{}: {}'.format(name, problem)
+        for (name, job) in jobs.items()
+        for problem in validate_job(job, schema, metadata)
+    ]
+    if problems:
+        raise ValueError('invalid jobs:\n  ' + '\n  '.join(problems))
+    (columns, filters) = job_projection(jobs.values(), metadata)
+    return {
+        'jobs': jobs,
+        'categories': {name: job_categories(job, metadata) for (name, job) in jobs.items()},
+        'columns': columns,
+        'filters': filters,
+    }
 
 
-analysis_6 = Analysis({
-    'aggregation':{
-        'Listened to music, or watched a musical performance online': ['q1_3'],
-        'Watched a live-streaming event or performance': ['q1_7'],
-        'Participated in a live interactive event online': ['q1_15'],
-    },
-    'categories': categories,
-    'filters': filters,
-    'labels': {
-        'title': 'Which of the following activities have you done in the past 30 days?',
-        'xlabel': 'Activity',
-        'ylabel': 'Proportion Responding Yes',
-    },
-    'questions': {
-        'q1_3': ['Listened to music, or watched a musical performance online'],
-        'q1_7': ['Watched a live-streaming event or performance'],
-        'q1_15': ['Participated in a live interactive event online'],
-    },
-    'sort_order': sort_order,
-})
-analysis_6.plots['seaborn_barplot'].get_figure().savefig('analysis_6', bbox_inches='tight')
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Render the CCTC report figures.')
+    parser.add_argument('jobs', nargs='*', help='report jobs to run (default: all)')
+    parser.add_argument('--spec', default=report_spec_path, help='job spec file (.json, or .yaml with PyYAML)')
+    parser.add_argument('--data', default=None, help='survey data: a Parquet cache or a pickled DataFrame')
+    parser.add_argument('--output-dir', default='.', help='directory for the PNGs')
+    parser.add_argument('--processes', type=int, default=None, help='rendering processes')
+    parser.add_argument('--parallel', action='store_true', help='compute jobs in worker processes instead of one shared batch')
+    parser.add_argument('--build-cache', metavar='SOURCE', nargs='?', const=excel_path, help='convert SOURCE (.xlsx or pickle; default: the Excel export) into the Parquet cache and exit')
+    parser.add_argument('--results', default=results_path, help='result cache directory')
+    parser.add_argument('--no-results', action='store_true', help='recompute every job, ignoring the result cache')
+    parser.add_argument('--export', default=None, help='Arrow results file that job tables are appended to (default: next to the data)')
+    parser.add_argument('--no-export', action='store_true', help='do not write the results file')
+    args = parser.parse_args(argv)
 
+    if args.build_cache:
+        build_cache(args.build_cache, args.data or cache_path)
+        return
 
-analysis_7 = Analysis({
-    'aggregation': {
-        'Hope': ['q6_1'],
-        'Humor': ['q6_2'],
-        'Distraction': ['q6_3'],
-        'Connection with other people': ['q6_4'],
-        'Staying informed': ['q6_5'],
-        'Getting outdoors': ['q6_6'],
-        'Expressing myself creatively': ['q6_7'],
-        'Being challenged': ['q6_8'],
-        'Fun': ['q6_9'],
-        'Feeling like I’m part of something': ['q6_10'],
-    },
-    'categories': categories,
-    'filters': filters,
-    'labels': {
-        'title': 'What do you want more of in your life right now?',
-        'xlabel': 'Want More',
-        'ylabel': 'Proportion Responding Yes',
-    },
-    'questions': {
-        'q6_1': ['Hope'],
-        'q6_2': ['Humor'],
-        'q6_3': ['Distraction'],
-        'q6_4': ['Connection with other people'],
-        'q6_5': ['Staying informed, with trusted information'],
-        'q6_6': ['Getting outdoors'],
-        'q6_7': ['Expressing myself creatively'],
-        'q6_8': ['Being challenged'],
-        'q6_9': ['Fun'],
-        'q6_10': ['Feeling like I’m part of something'],
-    },
-    'sort_order': sort_order,
-})
-analysis_7.plots['seaborn_barplot'].get_figure().savefig('analysis_7', bbox_inches='tight')
-
+    report_jobs = load_spec(args.spec)
+    names = args.jobs or list(report_jobs.keys())
+    unknown = [name for name in names if name not in report_jobs]
+    if unknown:
+        parser.error('unknown jobs: {}'.format(', '.join(unknown)))
+    data = resolve_data_path(args.data)
+    schema = load_schema(data=data)
+    try:
+        plan = compile_plan({name: report_jobs[name] for name in names}, schema)
+    except ValueError as error:
+        parser.error(str(error))
 
-analysis_8 = Analysis({
-    'aggregation': {
-        'a. I hope the arts & culture organizations\nin my area will change after the pandemic\nto be more relevant to people like me.': ['1'],
-        'b. The arts & culture organizations in my\narea are really struggling financially\nbecause of Covid-19.': ['2'],
-        'c. I’ve seen or heard about an arts or\ncultural organization in my area helping\nour community during the crisis in some\nspecific way.': ['3'],
-        'd. During this crisis, we should support\nother kinds of nonprofit organizations in\nmy area before supporting arts & culture\norganizations.': ['4'],
-        'e. I’m hearing a lot from arts & culture\norganizations during Covid-19, via emails,\nsocial media, etc.': ['5'],
-        'f. I wish I were hearing more from arts\n& culture organizations during Covid-19,\nvia emails, social media, etc.': ['99'],
-    },
-    'categories': categories,
-    'filters': filters,
-    'labels': {
-        'title': 'Please tell us how much you personally agree or disagree with the following statements.',
-        'xlabel': 'Question',
-        'ylabel': 'Proportion Responding Yes',
-    },
-    'questions': {'q19e': ['1', '2', '3', '4', '5', '99']},
-    'sort_order': sort_order,
-    'split_question': 'q19e',
-})
-analysis_8.plots['seaborn_barplot'].get_figure().savefig('analysis_8', bbox_inches='tight')
+    # Figure Settings
+    import seaborn as sns
+    sns.set(rc=figure_settings)
 
+    jobs = list(plan['jobs'].values())
+    filenames = [os.path.join(args.output_dir, name + '.png') for name in names]
+    analyses = [None] * len(jobs)
+    keys = [None] * len(jobs)
+    if not args.no_results:
+        results = ResultCache(args.results)
+        fingerprint = data_fingerprint(data)
+        for (i, job) in enumerate(jobs):
+            keys[i] = job_key(job, fingerprint)
+            result = results.get(keys[i])
+            if result is not None:
+                analyses[i] = Analysis.restore(result)
 
-analysis_9 = Analysis({
-    'aggregation': {
-        'Materials or activities for kids': ['q12_4'],
-        'Live-stream performances or events': ['q12_5'],
-        'Interactive events': ['q12_6'],
-        'Pre-recorded performances': ['q12_7'],
-        'Classes, courses, or workshops': ['q12_9'],
-        'Communit meetings or discussions': ['q12_10'],
-    },
-    'categories': categories,
-    'filters': filters,
-    'labels': {
-        'title': 'Have you done any of those online or digital cultural activities yourself in the past 30 days?',
-        'xlabel': 'Activity',
-        'ylabel': 'Proportion Responding Yes',
-    },
-    'questions': {
-        'q12_4': ['Online materials or activities for kids'],
-        'q12_5': ['Live-stream performances or cultural events'],
-        'q12_6': ['Interactive events online, where you can participate via chat, audio, or video'],
-        'q12_7': ['Pre-recorded performances filmed before the shutdowns'],
-        'q12_9': ['Online classes, courses, or workshops (from arts groups, zoos, etc.)'],
-        'q12_10': ['Online community meetings or discussions (presented by artists, zoos, etc.)'],
-    },
-    'sort_order': sort_order,
-})
-analysis_9.plots['seaborn_barplot'].get_figure().savefig('analysis_9', bbox_inches='tight')
-
-
-analysis_10 = Analysis({
-    'aggregation': {
-        'Pop, hip-hop, or rap music': ['q4_1'],
-        'Country music': ['q4_2'],
-        'Rock or alternative music': ['q4_3'],
-        'Jazz music': ['q4_4'],
-        'Folk music': ['q4_5'],
-        'Musical theater/Broadway': ['q4_6'],
-        'Live theater or drama': ['q4_7'],
-        'Classical music': ['q4_11'],
-        'Opera': ['q4_14'],
-        'Ballet': ['q4_15'],
-        'Contemporary dance': ['q4_16'],
-    },
-    'categories': categories,
-    'filters': filters,
-    'labels': {
-        'title': 'If you watched a special live-streaming event or performance in the past 30 days, what kind were they?',
-        'xlabel': 'Event or Performance Type',
-        'ylabel': 'Proportion Responding Yes',
-    },
-    'questions': {
-        'q4_1': ['Pop, hip-hop, or rap music'],
-        'q4_2': ['Country music'],
-        'q4_3': ['Rock or alternative music'],
-        'q4_4': ['Jazz music'],
-        'q4_5': ['Folk music'],
-        'q4_6': ['Musical theater or Broadway'],
-        'q4_7': ['Live theater or drama'],
-        'q4_11': ['Classical music'],
-        'q4_14': ['Opera'],
-        'q4_15': ['Ballet'],
-        'q4_16': ['Contemporary dance'],
-    },
-    'sort_order': sort_order,
-})
-analysis_10.plots['seaborn_barplot'].get_figure().savefig('analysis_10', bbox_inches='tight')
-
-
-analysis_11 = Analysis({
-    'aggregation': {
-        'Friendlier to all kinds of people': ['q28_1'],
-        'Less formal': ['q28_2'],
-        'Stories or content that connect to my life': ['q28_3'],
-        'More diverse voices and faces': ['q28_4'],
-        'More focus on our local community': ['q28_5'],
-        'More frequent new works or exhibits': ['q28_6'],
-        'More fun': ['q28_7'],
-        'Working with other nonprofits in our community': ['q28_8'],
-        'Supporting local artists, organizers, etc.': ['q28_9'],
-        'More child-friendly': ['q28_10'],
-        'Engage more young people': ['q28_11'],
-        'Treat their employees fairly and equitably': ['q28_12'],
-        'Nothing — I wouldn’t change them at all': ['q28_99'],
-    },
-    'categories': categories,
-    'filters': filters,
-    'labels': {
-        'title': 'Which of the following factors will most influence your decision to resume attending in-person arts & culture experiences?',
-        'xlabel': 'Factors',
-        'ylabel': 'Proportion Responding Yes',
-    },
-    'questions': {
-        'q28_1': ['Friendlier to all kinds of people'],
-        'q28_2': ['Less formal'],
-        'q28_3': ['Stories or content that connect to my life'],
-        'q28_4': ['More diverse voices and faces'],
-        'q28_5': ['More focus on our local community'],
-        'q28_6': ['More frequent new works or exhibits'],
-        'q28_7': ['More fun'],
-        'q28_8': ['Working with other nonprofits in our community'],
-        'q28_9': ['Supporting local artists, organizers, etc.'],
-        'q28_10': ['More child-friendly'],
-        'q28_11': ['Engage more young people'],
-        'q28_12': ['Treat their employees fairly and equitably'],
-        'q28_99': ['Nothing — I wouldn’t change them at all'],
-    },
-    'sort_order': sort_order,
-})
-for item in analysis_11.plots['seaborn_barplot'].get_xticklabels():
-    item.set_rotation(60)
-analysis_11.plots['seaborn_barplot'].get_figure().savefig('analysis_11', bbox_inches='tight')
+    missing = [i for i in range(len(jobs)) if analyses[i] is None]
+    if missing:
+        # Only the jobs not served from the result cache shape the load.
+        if len(missing) < len(jobs):
+            plan = compile_plan({names[i]: jobs[i] for i in missing}, schema)
+        missing_jobs = list(plan['jobs'].values())
+        missing_df = load_projection(plan['columns'], plan['filters'], path=data)
+        if args.parallel:
+            computed = run_parallel(missing_jobs, df=missing_df, processes=args.processes)
+        else:
+            computed = AnalysisBatch(missing_jobs, df=missing_df, plot=False)
+        for (i, analysis) in zip(missing, computed):
+            if isinstance(analysis, JobError):
+                sys.stderr.write('{}: {}\n'.format(names[i], analysis.trace))
+                continue
+            analyses[i] = analysis
+            if keys[i]:
+                results.put(keys[i], analysis)
 
+    if not args.no_export:
+        done = [i for i in range(len(jobs)) if analyses[i] is not None]
+        if done:
+            export_results(
+                [names[i] for i in done],
+                [analyses[i] for i in done],
+                args.export or os.path.join(os.path.dirname(data), os.path.basename(export_path)),
+                [keys[i] for i in done],
+            )
 
-analysis_12 = Analysis({
-    'aggregation': {
-        'Before the pandemic': ['q23_12'],
-        'During the pandemic': ['q24_12'],
-    },
-    'categories': categories,
-    'filters': filters,
-    'labels': {
-        'title': 'Donated to Dance Organizations',
-        'xlabel': 'When?',
-        'ylabel': 'Proportion Responding Yes',
-    },
-    'questions': {
-        'q23_12': ['Dance group'],
-        'q24_12': ['Dance group'],
-    },
-    'sort_order': sort_order,
-})
-analysis_12.plots['seaborn_barplot'].get_figure().savefig('analysis_12', bbox_inches='tight')
-
-# Income by generation
-Analysis({
-    'categories': ['generation'],
-    'filters': filters,
-    'labels': {
-        'title': 'Which of the following ranges describes your annual household income for 2019?',
-        'xlabel': 'Income',
-        'ylabel': 'Proportion Responding Yes',
-    },
-    'questions': {
-        'q42': [
-            'Prefer not to answer',
-            'Under $25,000',
-            '$25,000–$49,999',
-            '$50,000–$99,999',
-            '$100,000–$149,999',
-            '$150,000–$199,999',
-            '$200,000 or more',
-        ]
-    },
-    'sort_order': sort_order,
-    'split_question': 'q42',
-}).plots['seaborn_barplot'].get_figure().savefig('analysis_income', bbox_inches='tight')
+    render = [
+        i for i in range(len(jobs))
+        if analyses[i] is not None and not (keys[i] and results.get_png(keys[i], filenames[i]))
+    ]
+    render_all([
+        render_task(analyses[i], filenames[i]) for i in render
+    ], processes=args.processes)
+    for i in render:
+        if keys[i]:
+            results.put_png(keys[i], filenames[i])
 
-# Participation
-Analysis({
-    'aggregation': {
-        'ArtMuseum': ['q7_1'],
-        'FoodAndDrink': ['q7_17'],
-        'Theater': ['q7_18', 'q7_19'],
-        'Music': ['q7_21', 'q7_22', 'q7_23', 'q7_24', 'q7_25'],
-        'Dance': ['q7_26', 'q7_27', 'q7_28'],
-    },
-    'categories': categories,
-    'filters': {
-        'region_small': ['Middle Atlantic']
-    },
-    'labels': {
-        'title': 'Did you do any of the following activities last year (2019)?',
-        'xlabel': 'Activity',
-        'ylabel': 'Proportion Responding Yes',
-    },
-    'questions': {
-        'q7_1': ['Art museum'],
-        'q7_17': ['Food and drink experience'],
-        'q7_18': ['Play (non-musical)'],
-        'q7_19': ['Musical'],
-        'q7_21': ['Popular music'],
-        'q7_22': ['Classical music'],
-        'q7_23': ['Jazz music'],
-        'q7_24': ['Opera'],
-        'q7_25': ['World music'],
-        'q7_26': ['Contemporary dance'],
-        'q7_27': ['Ballet'],
-        'q7_28': ['Regional dance'],
-    },
-    'sort_order': sort_order,
-}).plots['seaborn_barplot'].get_figure().savefig('analysis_1a', bbox_inches='tight')
 
-df[df['REGION9'] == 'East North Central'].shape
-df[df['StateName'] == 'Indiana'].shape
-df[df['CityName'] == 'Indianapolis'].shape
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+import argparse
+import itertools
+import json
+import sys
+import time
+import tracemalloc
+
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+
+from analysis import Analysis, metadata
+
+
+# Synthetic data
+def synthetic_df(rows, questions, groups, answers=4, seed=0, metadata=metadata):
+    # One column per metadata category (the grouping column `agegen` gets
+    # `groups` distinct values, the rest a handful), then `questions` answer
+    # columns q0_1..q0_N holding one of `answers` strings or a blank.
+    rng = np.random.default_rng(seed)
+    data = {}
+    for (key, column) in metadata['categories'].items():
+        n_values = groups if key == 'generation' else 5
+        values = np.array(['{} {}'.format(key, i) for i in range(n_values)], dtype=object)
+        data[column] = values[rng.integers(0, n_values, rows)]
+    choices = np.array(['Answer {}'.format(i) for i in range(answers)] + [np.nan], dtype=object)
+    for i in range(1, questions + 1):
+        data['q0_{}'.format(i)] = choices[rng.integers(0, answers + 1, rows)]
+    return pd.DataFrame(data)
+
+
+def synthetic_job(shape, questions, groups):
+    generations = ['generation {}'.format(i) for i in range(groups)]
+    job = {
+        'categories': ['generation', 'income_bracket'],
+        'filters': {
+            'region_small': ['region_small 0', 'region_small 1', 'region_small 2'],
+            'generation': generations,
+        },
+        'sort_order': generations,
+    }
+    if shape == 'split_question':
+        job['questions'] = {'q0_1': ['Answer {}'.format(i) for i in range(4)]}
+        job['split_question'] = 'q0_1'
+    else:
+        job['questions'] = {'q0_{}'.format(i): ['Answer 0'] for i in range(1, questions + 1)}
+    if shape == 'aggregation':
+        names = list(job['questions'])
+        job['aggregation'] = {
+            'group {}'.format(i): names[i:i + 3] for i in range(0, len(names), 3)
+        }
+    return job
+
+
+# Measurement
+stages = [
+    'filter_self',
+    'collect_answers',
+    'aggregate_answers',
+    'get_proportions_df',
+    'sort_proportions_melted_df',
+    'make_seaborn_barplot',
+]
+
+
+def measure(function):
+    tracemalloc.start()
+    start = time.perf_counter()
+    function()
+    seconds = time.perf_counter() - start
+    (_, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return seconds, peak
+
+
+def benchmark(df, job, plot=False, repeat=1):
+    results = {stage: {'seconds': [], 'peak_bytes': []} for stage in stages}
+    for _ in range(repeat):
+        analysis = Analysis(job, df=df, lazy=True)
+        for stage in stages:
+            if stage == 'make_seaborn_barplot':
+                if not plot:
+                    continue
+                (seconds, peak) = measure(analysis.make_seaborn_barplot)
+                plt.close('all')
+            else:
+                (seconds, peak) = measure(getattr(analysis, stage))
+            results[stage]['seconds'].append(seconds)
+            results[stage]['peak_bytes'].append(peak)
+        rows_out = analysis.dataframes['df'].shape[0]
+    return {
+        stage: {
+            'seconds': min(result['seconds']),
+            'peak_bytes': max(result['peak_bytes']),
+            'rows': rows_out,
+        }
+        for (stage, result) in results.items() if result['seconds']
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Time each Analysis stage on synthetic survey data.')
+    parser.add_argument('--rows', type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument('--questions', type=int, nargs='+', default=[10, 100])
+    parser.add_argument('--groups', type=int, nargs='+', default=[5, 50])
+    parser.add_argument('--shapes', nargs='+', default=['aggregation', 'split_question', 'plain'])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--plot', action='store_true', help='also time make_seaborn_barplot')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='-', help='JSON lines file (default: stdout)')
+    args = parser.parse_args(argv)
+
+    output = sys.stdout if args.output == '-' else open(args.output, 'a')
+    for (rows, questions, groups) in itertools.product(args.rows, args.questions, args.groups):
+        df = synthetic_df(rows, questions, groups, seed=args.seed)
+        for shape in args.shapes:
+            job = synthetic_job(shape, questions, groups)
+            for (stage, result) in benchmark(df, job, args.plot, args.repeat).items():
+                output.write(json.dumps({
+                    'shape': shape,
+                    'rows': rows,
+                    'questions': questions,
+                    'groups': groups,
+                    'stage': stage,
+                    'seconds': result['seconds'],
+                    'peak_bytes': result['peak_bytes'],
+                    'rows_after_filter': result['rows'],
+                }) + '\n')
+            output.flush()
+    if output is not sys.stdout:
+        output.close()
+
+
+if __name__ == '__main__':
+    main()